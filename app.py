@@ -1,10 +1,26 @@
 import streamlit as st
 import pandas as pd
 from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DataError
 import os
 from dotenv import load_dotenv
+from db_partitioning import PARTITIONED_TABLES, write_partitioned
 import datetime
 import random
+import re
+import uuid
+import queue
+from contextlib import contextmanager
+
+try:
+    # Percorso Arrow-native (opzionale): il driver ADBC legge i risultati direttamente in record batch
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import adbc_driver_postgresql.dbapi as adbc_pg
+except ImportError:
+    pa = None
+    pq = None
+    adbc_pg = None
 
 # --- 1. CONFIGURAZIONE E TEMA ---
 st.set_page_config(page_title="Executive SAP Academy", page_icon="🎓", layout="wide")
@@ -74,15 +90,691 @@ def write_audit_log(username, modulo, query_eseguita, status):
     except Exception:
         pass # Ignora gli errori per non bloccare mai l'app all'utente
 
+def get_setting(name, default):
+    """Legge una soglia dai Secrets di Streamlit Cloud, altrimenti dal file .env"""
+    try:
+        return st.secrets[name]
+    except Exception:
+        return os.getenv(name, default)
+
+# --- SANDBOX PERSONALI (uno schema + un ruolo per studente, solo PostgreSQL) ---
+# Lo schema personale precede "public" nel search_path: le letture ricadono sui dati S/4HANA condivisi,
+# mentre tabelle create/importate e copie copy-on-write restano nella sandbox dello studente.
+# L'isolamento è garantito dal database: le istruzioni della Sandbox girano con SET LOCAL ROLE sul ruolo
+# dello studente, che ha solo SELECT su public e possiede il proprio schema sbx_*.
+SANDBOX_ENABLED = engine.url.get_backend_name() == "postgresql"
+SANDBOX_IDLE_MINUTES = float(get_setting("SANDBOX_IDLE_MINUTES", 120))
+# LAST_SEEN serve solo al GC (soglia in ore): basta aggiornarlo una volta al minuto, non a ogni connessione
+SANDBOX_TOUCH_SECONDS = 60
+# Ruoli creati dall'app: l'utente di DATABASE_URL deve avere CREATEROLE (altrimenti niente sandbox, vedi avvio sessione)
+SANDBOX_GROUP_ROLE = "sbx_students"
+
+def sandbox_schema_name(username):
+    # Lo stesso nome identifica schema e ruolo dello studente
+    return "sbx_" + re.sub(r"\W", "_", username.lower())[:50]
+
+def _setup_sandbox_group(conn):
+    """Ruolo di gruppo con la sola lettura dello schema condiviso (anche per le tabelle ricreate dai generatori)"""
+    conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('sbx_setup'))"))
+    conn.execute(text(f"""
+        DO $$ BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = '{SANDBOX_GROUP_ROLE}') THEN
+                CREATE ROLE "{SANDBOX_GROUP_ROLE}" NOLOGIN;
+            END IF;
+        END $$
+    """))
+    conn.execute(text(f'GRANT USAGE ON SCHEMA public TO "{SANDBOX_GROUP_ROLE}"'))
+    conn.execute(text(f'GRANT SELECT ON ALL TABLES IN SCHEMA public TO "{SANDBOX_GROUP_ROLE}"'))
+    conn.execute(text(f'ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT SELECT ON TABLES TO "{SANDBOX_GROUP_ROLE}"'))
+
+def _touch_sandbox(conn, schema, username):
+    conn.execute(text(f"""
+        DO $$ BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = '{schema}') THEN
+                CREATE ROLE "{schema}" NOLOGIN IN ROLE "{SANDBOX_GROUP_ROLE}";
+                EXECUTE format('GRANT %I TO %I', '{schema}', current_user);
+            END IF;
+        END $$
+    """))
+    conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema}" AUTHORIZATION "{schema}"'))
+    conn.execute(text("""
+        INSERT INTO "Z_SANDBOX_REGISTRY" ("SCHEMA_NAME", "USERNAME", "LAST_SEEN") VALUES (:schema, :username, now())
+        ON CONFLICT ("SCHEMA_NAME") DO UPDATE SET "LAST_SEEN" = now()
+    """), {"schema": schema, "username": username})
+
+def ensure_sandbox(username):
+    """Crea la sandbox personale (schema vuoto, millisecondi) e ripulisce quelle inattive; None fuori da PostgreSQL"""
+    if not SANDBOX_ENABLED:
+        return None
+    schema = sandbox_schema_name(username)
+    with engine.begin() as conn:
+        if not conn.execute(text("SELECT rolcreaterole OR rolsuper FROM pg_roles WHERE rolname = current_user")).scalar():
+            raise RuntimeError("l'utente del database non ha il privilegio CREATEROLE")
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS "Z_SANDBOX_REGISTRY" (
+                "SCHEMA_NAME" VARCHAR(63) PRIMARY KEY,
+                "USERNAME" VARCHAR(50),
+                "LAST_SEEN" TIMESTAMP
+            )
+        """))
+        _setup_sandbox_group(conn)
+        idle = conn.execute(text("""
+            DELETE FROM "Z_SANDBOX_REGISTRY"
+            WHERE "LAST_SEEN" < now() - :minutes * interval '1 minute' AND "SCHEMA_NAME" <> :schema
+            RETURNING "SCHEMA_NAME"
+        """), {"minutes": SANDBOX_IDLE_MINUTES, "schema": schema}).scalars().all()
+        for idle_schema in idle:
+            conn.execute(text(f'DROP SCHEMA IF EXISTS "{idle_schema}" CASCADE'))
+            conn.execute(text(f'DROP ROLE IF EXISTS "{idle_schema}"'))
+        _touch_sandbox(conn, schema, username)
+    return schema
+
+def refresh_sandbox():
+    """Aggiorna LAST_SEEN e ricrea ruolo/schema se il GC li ha rimossi, al massimo una volta ogni SANDBOX_TOUCH_SECONDS"""
+    schema = st.session_state.sandbox_schema
+    now = datetime.datetime.now().timestamp()
+    if schema is None or now - st.session_state.get("sandbox_touched_at", 0) < SANDBOX_TOUCH_SECONDS:
+        return
+    with engine.begin() as conn:
+        _touch_sandbox(conn, schema, st.session_state.username)
+    st.session_state.sandbox_touched_at = now
+
+@contextmanager
+def sandbox_connection():
+    """Connessione della Sandbox: ruolo dello studente e search_path sulla sua sandbox, validi solo per la transazione
+    corrente. Fuori da PostgreSQL resta la semplice engine.connect() di sempre."""
+    schema = st.session_state.sandbox_schema
+    refresh_sandbox()
+    with engine.connect() as conn:
+        if schema is None:
+            yield conn
+            return
+        conn.execute(text(f'SET LOCAL ROLE "{schema}"'))
+        conn.execute(text("SELECT set_config('search_path', :path, true)"), {"path": f'"{schema}", public'})
+        yield conn
+
+def copy_on_write(conn, schema, tables, with_data=True):
+    """Prima scrittura su una tabella condivisa: ne crea la copia privata nella sandbox, che da lì in poi la oscura.
+    Le tabelle partizionate vengono copiate per intero (madre + figlie) in un'unica tabella piatta."""
+    if schema is None:
+        return
+    for table in tables:
+        if conn.execute(text("SELECT to_regclass(:name)"), {"name": f'"{schema}"."{table}"'}).scalar() is not None:
+            continue
+        conn.execute(text(f'CREATE TABLE "{schema}"."{table}" (LIKE public."{table}" INCLUDING DEFAULTS)'))
+        if with_data:
+            conn.execute(text(f'INSERT INTO "{schema}"."{table}" SELECT * FROM public."{table}"'))
+
+def _adbc_uri():
+    """Restituisce la URI libpq per il driver ADBC, oppure None se il percorso Arrow non è disponibile"""
+    if adbc_pg is None or not SANDBOX_ENABLED:
+        return None
+    # ADBC parla libpq direttamente: rimuoviamo il suffisso del driver SQLAlchemy (es. +psycopg2)
+    return engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+def run_sandbox_query(query):
+    """Esegue la query nella sandbox personale: pyarrow.Table (PostgreSQL + ADBC) o DataFrame (fallback) per le letture,
+    None per scritture/DDL (eseguite e confermate sulle copie private)"""
+    cleaned = _strip_literals(query)
+    schema = st.session_state.sandbox_schema
+    if WRITE_KEYWORDS.search(cleaned):
+        # La regex decide solo quando preparare le copie: i permessi li fa rispettare il ruolo dello studente
+        with sandbox_connection() as conn:
+            for verb, table in _shared_write_targets(cleaned):
+                copy_on_write(conn, schema, [table], with_data=verb not in ("DROP", "TRUNCATE"))
+            conn.execute(text(query))
+            conn.commit()
+        return None
+    uri = _adbc_uri()
+    if uri is None:
+        with sandbox_connection() as conn:
+            return pd.read_sql(text(query), conn)
+    refresh_sandbox()
+    with adbc_connection(uri) as conn, conn.cursor() as cur:
+        _begin_adbc_sandbox(cur, schema)
+        cur.execute(query)
+        table = cur.fetch_arrow_table()
+        # Fine lettura: ROLLBACK esplicito, ruolo e search_path decadono e la connessione torna libera
+        cur.execute("ROLLBACK")
+    return _cast_numeric_columns(table)
+
+ADBC_POOL_SIZE = int(get_setting("ADBC_POOL_SIZE", 5))
+
+@st.cache_resource
+def _adbc_pool():
+    # Connessioni ADBC inattive, condivise da tutte le sessioni del processo (come il pool di SQLAlchemy)
+    return queue.LifoQueue()
+
+@contextmanager
+def adbc_connection(uri):
+    """Connessione ADBC dal pool: niente handshake libpq/TLS a ogni query e nessuna connessione legata alla vita
+    di una sessione Streamlit. In autocommit le transazioni sono solo quelle aperte esplicitamente con BEGIN."""
+    pool = _adbc_pool()
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = adbc_pg.connect(uri, autocommit=True)
+    reusable = False
+    try:
+        yield conn
+        reusable = True
+    finally:
+        # Dopo un errore (SQL, server riavviato, lettura interrotta) la transazione può essere ancora aperta: la scartiamo
+        if reusable and pool.qsize() < ADBC_POOL_SIZE:
+            pool.put(conn)
+        else:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+def _begin_adbc_sandbox(cur, schema):
+    cur.execute("BEGIN")
+    if schema is not None:
+        cur.execute(f'SET LOCAL ROLE "{schema}"')
+        cur.execute(f'SET LOCAL search_path TO "{schema}", public')
+
+def _cast_numeric_columns(table):
+    """Il driver ADBC restituisce NUMERIC (es. SUM/AVG su bigint) come stringhe, marcate nei metadati del campo:
+    le convertiamo in float64 come faceva pd.read_sql con i Decimal, così tabella e grafico restano numerici"""
+    for position, field in enumerate(table.schema):
+        typname = (field.metadata or {}).get(b"ADBC:postgresql:typname")
+        if typname == b"numeric" and (pa.types.is_string(field.type) or pa.types.is_large_string(field.type)):
+            table = table.set_column(position, pa.field(field.name, pa.float64()), table.column(position).cast(pa.float64()))
+    return table
+
+# --- PRE-FLIGHT (EXPLAIN senza ANALYZE) ---
+# Tabelle S/4HANA condivise tra tutti gli studenti: le scritture finiscono su copie copy-on-write nella sandbox
+SHARED_SAP_TABLES = {
+    'LFA1', 'MARA', 'EKKO', 'EKPO', 'BKPF', 'BSEG', 'KNA1', 'VBAK', 'VBAP',
+    'CSKS', 'EQUI', 'AFIH', 'AFVC',
+}
+# Tabelle di sistema: mai modificabili dalla Sandbox
+PROTECTED_TABLES = {'Z_SM20_AUDIT', 'Z_SANDBOX_REGISTRY'}
+WRITE_KEYWORDS = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|DROP|ALTER|CREATE|GRANT|REVOKE|COPY|VACUUM|REINDEX)\b", re.IGNORECASE)
+WRITE_TARGETS = re.compile(
+    r"\b(INSERT\s+INTO|UPDATE|DELETE\s+FROM|MERGE\s+INTO|TRUNCATE(?:\s+TABLE)?|DROP\s+TABLE(?:\s+IF\s+EXISTS)?|ALTER\s+TABLE(?:\s+IF\s+EXISTS)?"
+    r"|CREATE\s+(?:UNIQUE\s+)?INDEX\b[^;]*?\bON|CREATE\s+(?:OR\s+REPLACE\s+)?(?:TRIGGER|RULE|POLICY)\b[^;]*?\bON)"
+    r'\s+(?:ONLY\s+)?(?:("?\w+"?)\s*\.\s*)?("?\w+"?)',
+    re.IGNORECASE,
+)
+# TRUNCATE / DROP TABLE accettano una lista di tabelle: servono tutte per il copy-on-write
+WRITE_TARGET_LISTS = re.compile(
+    r'\b(TRUNCATE(?:\s+TABLE)?|DROP\s+TABLE(?:\s+IF\s+EXISTS)?)\s+((?:ONLY\s+)?[\w".]+(?:\s*,\s*[\w".]+)*)',
+    re.IGNORECASE,
+)
+# Partizioni figlie delle tabelle condivise (BSEG_2024, EKKO_2025_03, EKKO_DEFAULT)
+SHARED_PARTITION = re.compile(r"^(%s)_(\d{4}(_\d{2})?|DEFAULT)$" % "|".join(PARTITIONED_TABLES))
+# Il SET LOCAL ROLE della Sandbox si può sempre annullare tornando al session_user: blocchiamo i cambi di ruolo
+# e il codice procedurale/SQL dinamico che potrebbe farlo (cercati anche dentro le stringhe)
+ROLE_SWITCH = re.compile(
+    r"\b(ROLE|SESSION\s+AUTHORIZATION|RESET|DISCARD|set_config|FUNCTION|PROCEDURE|CALL|EXECUTE|PREPARE|query_to_xml\w*|dblink\w*)\b|U&",
+    re.IGNORECASE,
+)
+EXPLAINABLE_STATEMENTS = ('SELECT', 'WITH', 'VALUES', 'TABLE', 'INSERT', 'UPDATE', 'DELETE', 'MERGE')
+# Anche CREATE TABLE ... AS e CREATE MATERIALIZED VIEW eseguono una SELECT: passano dallo stesso EXPLAIN
+CREATE_AS_STATEMENT = re.compile(
+    r"CREATE\s+(?:(?:GLOBAL|LOCAL)\s+)?(?:(?:TEMP|TEMPORARY|UNLOGGED)\s+)?"
+    r'(?:TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[\w".]+\s*(?:\([^)]*\)\s*)?AS\b|MATERIALIZED\s+VIEW\b)',
+    re.IGNORECASE,
+)
+
+SANDBOX_MAX_COST = float(get_setting("SANDBOX_MAX_COST", 1_000_000))
+SANDBOX_MAX_ROWS = float(get_setting("SANDBOX_MAX_ROWS", 500_000))
+
+def _strip_literals(query):
+    """Rimuove commenti e stringhe tra apici, così 'DROP' dentro un testo non conta come DDL"""
+    query = re.sub(r"--[^\n]*|/\*.*?\*/", " ", query, flags=re.S)
+    return re.sub(r"'(?:[^']|'')*'", "''", query)
+
+def _statement_body(query):
+    """Testo della query da racchiudere in COPY (...) / EXPLAIN: commenti e ; finali rimossi, stringhe e
+    identificatori tra virgolette intatti (un -- finale commenterebbe la parentesi di chiusura)"""
+    tokens = re.findall(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/|[^'\"\-/]+|.", query, flags=re.S)
+    body = "".join(" " if token.startswith(("--", "/*")) else token for token in tokens)
+    return body.strip().rstrip(";").strip()
+
+def _referenced_shared_tables(query):
+    identifiers = re.findall(r'"([^"]+)"|\b(\w+)\b', query)
+    names = {quoted or bare.upper() for quoted, bare in identifiers}
+    return sorted(names & (SHARED_SAP_TABLES | PROTECTED_TABLES))
+
+def _identifier(token):
+    return token.strip('"') if token.startswith('"') else token.upper()
+
+def _write_targets(query):
+    """Tabelle bersaglio di scritture/DDL: lista di (verbo, schema o None, tabella)"""
+    targets = [
+        (verb.split()[0].upper(), _identifier(schema).lower() if schema else None, _identifier(table))
+        for verb, schema, table in WRITE_TARGETS.findall(query)
+    ]
+    for verb, names in WRITE_TARGET_LISTS.findall(query):
+        for name in names.split(","):
+            parts = re.sub(r"^ONLY\s+", "", name.strip(), flags=re.IGNORECASE).split(".")
+            schema = _identifier(parts[0]).lower() if len(parts) == 2 else None
+            targets.append((verb.split()[0].upper(), schema, _identifier(parts[-1])))
+    return list(dict.fromkeys(targets))
+
+def _shared_write_targets(query):
+    return [(verb, table) for verb, schema, table in _write_targets(query) if schema is None and table in SHARED_SAP_TABLES]
+
+def _plan_relations(node):
+    relations = [node["Relation Name"]] if "Relation Name" in node else []
+    for child in node.get("Plans", []):
+        relations += _plan_relations(child)
+    return relations
+
+def _cartesian_hint(node):
+    """Cerca un Nested Loop senza condizione di join (prodotto cartesiano) nel piano"""
+    children = node.get("Plans", [])
+    if node.get("Node Type") == "Nested Loop" and "Join Filter" not in node and len(children) == 2:
+        inner_has_cond = any(k in children[1] for k in ("Index Cond", "Recheck Cond", "Filter"))
+        if not inner_has_cond:
+            outer, inner = _plan_relations(children[0]), _plan_relations(children[1])
+            if outer and inner:
+                return f"manca probabilmente una condizione di JOIN tra `{', '.join(outer)}` e `{', '.join(inner)}`"
+    for child in children:
+        hint = _cartesian_hint(child)
+        if hint:
+            return hint
+    return None
+
+def _explain_plan(conn, query):
+    return conn.execute(text(f"EXPLAIN (FORMAT JSON) {_statement_body(query)}")).scalar()[0]["Plan"]
+
+def preflight_check(query, confirmed=False):
+    """Controllo preventivo della query: restituisce il motivo del blocco, oppure None se può essere eseguita"""
+    cleaned = _strip_literals(query)
+    if ";" in cleaned.strip().rstrip(";"):
+        return "⛔ **Operazione bloccata:** la Sandbox esegue una sola istruzione SQL per volta."
+    if ROLE_SWITCH.search(query) or re.match(r"\s*DO\b", cleaned, re.IGNORECASE):
+        return "⛔ **Operazione bloccata:** cambi di ruolo, funzioni e SQL dinamico non sono ammessi in Sandbox."
+    if SANDBOX_ENABLED and st.session_state.sandbox_schema is None and _shared_write_targets(cleaned):
+        # Sandbox non disponibile: senza copie private le scritture finirebbero sui dati condivisi da tutti
+        return "⛔ **Operazione bloccata:** la sandbox personale non è disponibile, le tabelle S/4HANA condivise sono in sola lettura."
+    # I controlli seguenti servono solo a dare un messaggio chiaro: i permessi li fa comunque rispettare il database
+    if WRITE_KEYWORDS.search(cleaned):
+        partitions = sorted({table for _, _, table in _write_targets(cleaned) if SHARED_PARTITION.match(table)})
+        if partitions:
+            return f"⛔ **Operazione bloccata:** le partizioni ({', '.join(partitions)}) non sono scrivibili: scrivi sulla tabella madre, che verrà copiata nella tua sandbox."
+        protected = sorted({table for _, _, table in _write_targets(cleaned) if table in PROTECTED_TABLES})
+        if protected:
+            return f"⛔ **Operazione bloccata:** le tabelle di sistema ({', '.join(protected)}) non sono modificabili dalla Sandbox."
+        if re.search(r'"?\bpublic"?\s*\.', cleaned, re.IGNORECASE):
+            return "⛔ **Operazione bloccata:** le scritture sono ammesse solo nella tua sandbox personale, non sullo schema condiviso `public`."
+        if re.search(r"\b(GRANT|REVOKE|COPY)\b", cleaned, re.IGNORECASE) and _referenced_shared_tables(cleaned):
+            return f"⛔ **Operazione bloccata:** `GRANT`/`REVOKE`/`COPY` non sono ammessi sulle tabelle condivise ({', '.join(_referenced_shared_tables(cleaned))})."
+    # Le parentesi iniziali, es. (SELECT ...) UNION (SELECT ...), non devono nascondere l'istruzione al controllo di costo
+    statement = re.sub(r"^[\s(]+", "", cleaned)
+    if re.match(r"EXPLAIN\b", statement, re.IGNORECASE) and re.search(r"\bANALY[SZ]E\b", statement, re.IGNORECASE):
+        return "⛔ **Operazione bloccata:** `EXPLAIN ANALYZE` esegue davvero la query: usa `EXPLAIN` senza `ANALYZE` per vedere il piano."
+    first_keyword = statement.split(None, 1)[0].upper() if statement else ""
+    explainable = first_keyword in EXPLAINABLE_STATEMENTS or CREATE_AS_STATEMENT.match(statement)
+    if confirmed or not SANDBOX_ENABLED or not explainable:
+        return None
+    with sandbox_connection() as conn:
+        # EXPLAIN verifica i permessi come l'esecuzione: sotto il ruolo dello studente le tabelle condivise sono in sola
+        # lettura, quindi il bersaglio va spiegato sulla sua futura copia privata (solo struttura), poi annullata dal rollback
+        for _, table in _shared_write_targets(cleaned):
+            copy_on_write(conn, st.session_state.sandbox_schema, [table], with_data=False)
+        plan = _explain_plan(conn, query)
+        conn.rollback()
+    total_cost, plan_rows = plan["Total Cost"], plan["Plan Rows"]
+    if total_cost <= SANDBOX_MAX_COST and plan_rows <= SANDBOX_MAX_ROWS:
+        return None
+    hint = _cartesian_hint(plan) or "aggiungi un filtro `WHERE`, un `LIMIT` o aggrega i dati con `GROUP BY`"
+    return (f"🚦 **Query troppo onerosa:** costo stimato {total_cost:,.0f} (soglia {SANDBOX_MAX_COST:,.0f}), "
+            f"righe stimate {plan_rows:,.0f} (soglia {SANDBOX_MAX_ROWS:,.0f}). "
+            f"💡 **Hint:** {hint}. Spunta la conferma per eseguirla comunque.")
+
+def _is_arrow(result):
+    return pa is not None and isinstance(result, pa.Table)
+
+def _chart_frame(result):
+    """Estrae solo le prime due colonne per il grafico, senza convertire l'intero risultato in pandas"""
+    if not _is_arrow(result):
+        return result.iloc[:, :2]
+    label, value = result.column(0), result.column(1)
+    if pa.types.is_decimal(value.type):
+        value = value.cast(pa.float64())
+    return pa.table([label, value], names=result.column_names[:2]).to_pandas()
+
+def _is_numeric_column(result, position):
+    if _is_arrow(result):
+        col_type = result.schema.field(position).type
+        return pa.types.is_integer(col_type) or pa.types.is_floating(col_type) or pa.types.is_decimal(col_type)
+    return pd.api.types.is_numeric_dtype(result.iloc[:, position])
+
+def render_sandbox_result(result, chart_title, chart_color, hint_msg, warning_msg):
+    """Tabella + grafico SAC della Sandbox: accetta sia pyarrow.Table sia DataFrame"""
+    if result is None:
+        if st.session_state.sandbox_schema is not None:
+            st.success(f"✅ Istruzione eseguita nella tua sandbox personale (`{st.session_state.sandbox_schema}`).")
+        else:
+            st.success("✅ Istruzione eseguita.")
+        return
+    col_tab, col_chart = st.columns(2)
+    with col_tab:
+        st.dataframe(result, use_container_width=True)
+    with col_chart:
+        if result.shape[1] >= 2:
+            if _is_numeric_column(result, 1):
+                st.markdown(chart_title)
+                chart_data = _chart_frame(result)
+                col1_name, col2_name = chart_data.columns[0], chart_data.columns[1]
+                st.bar_chart(chart_data.set_index(col1_name)[col2_name], color=chart_color)
+            else:
+                st.info(hint_msg)
+        else:
+            st.warning(warning_msg)
+
+# --- EXPORT STREAMING (CSV / Parquet) ---
+EXPORT_MAX_MB = float(get_setting("EXPORT_MAX_MB", 200))
+EXPORT_BATCH_ROWS = 50_000
+EXPORT_PROGRESS_STEP = 1024 * 1024
+# I file pronti vengono serviti in streaming dallo static serving di Streamlit (.streamlit/config.toml)
+# su app/static/exports/<token>: il download non passa mai dalla memoria dell'app
+EXPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "exports")
+EXPORT_TTL_MINUTES = float(get_setting("EXPORT_TTL_MINUTES", 30))
+
+class _ExportSink:
+    """Destinazione di COPY ... TO STDOUT: scrive su file temporaneo, aggiorna la progress bar e applica il limite"""
+
+    def __init__(self, target, progress, estimated_bytes, max_bytes):
+        self.target = target
+        self.progress = progress
+        self.estimated_bytes = max(estimated_bytes, 1)
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.next_update = EXPORT_PROGRESS_STEP
+
+    def write(self, chunk):
+        self.written += len(chunk)
+        if self.written > self.max_bytes:
+            raise ValueError(f"Export oltre il limite di {EXPORT_MAX_MB:,.0f} MB: aggiungi un filtro WHERE o un LIMIT.")
+        self.target.write(chunk)
+        if self.written >= self.next_update:
+            self.next_update += EXPORT_PROGRESS_STEP
+            self.progress.progress(min(self.written / self.estimated_bytes, 0.99), text=f"⏳ {self.written / 1024 / 1024:,.1f} MB esportati...")
+
+def _export_csv(query, target, progress):
+    """CSV via COPY (query) TO STDOUT: PostgreSQL produce il testo, l'app lo inoltra a blocchi sul file"""
+    with sandbox_connection() as conn:
+        plan = _explain_plan(conn, query)
+        sink = _ExportSink(target, progress, plan["Plan Rows"] * plan["Plan Width"], EXPORT_MAX_MB * 1024 * 1024)
+        with conn.connection.cursor() as cur:
+            cur.copy_expert(f"COPY ({_statement_body(query)}) TO STDOUT WITH (FORMAT csv, HEADER true)", sink)
+
+def _export_parquet(query, target, progress):
+    """Parquet a batch: record batch ADBC se disponibile, altrimenti cursore server-side psycopg2"""
+    max_bytes = EXPORT_MAX_MB * 1024 * 1024
+    schema = st.session_state.sandbox_schema
+    with sandbox_connection() as conn:
+        estimated_rows = max(_explain_plan(conn, query)["Plan Rows"], 1)
+        if _adbc_uri() is not None:
+            batches = _adbc_batches(query, schema)
+        else:
+            batches = _cursor_batches(conn, query)
+        writer, rows = None, 0
+        try:
+            for batch in batches:
+                if writer is None:
+                    writer = pq.ParquetWriter(target, batch.schema)
+                writer.write_table(batch.cast(writer.schema))
+                rows += batch.num_rows
+                if target.tell() > max_bytes:
+                    raise ValueError(f"Export oltre il limite di {EXPORT_MAX_MB:,.0f} MB: aggiungi un filtro WHERE o un LIMIT.")
+                progress.progress(min(rows / estimated_rows, 0.99), text=f"⏳ {rows:,} righe esportate...")
+        finally:
+            if writer is not None:
+                writer.close()
+
+def _adbc_batches(query, schema):
+    with adbc_connection(_adbc_uri()) as conn, conn.cursor() as cur:
+        _begin_adbc_sandbox(cur, schema)
+        cur.execute(query)
+        reader = cur.fetch_record_batch()
+        empty = True
+        for batch in reader:
+            empty = False
+            yield _cast_numeric_columns(pa.Table.from_batches([batch]))
+        if empty:
+            # Risultato vuoto: un file Parquet valido con il solo schema
+            yield _cast_numeric_columns(reader.schema.empty_table())
+        cur.execute("ROLLBACK")
+
+def _arrow_field(column):
+    """Tipo Arrow dal type_code (OID PostgreSQL) del cursore: lo schema resta uguale per tutti i batch, anche se il primo
+    contiene solo NULL. NUMERIC diventa float64 come nel percorso ADBC, i tipi non mappati testo."""
+    arrow_types = {
+        16: pa.bool_(), 20: pa.int64(), 21: pa.int64(), 23: pa.int64(),
+        700: pa.float64(), 701: pa.float64(), 1700: pa.float64(),
+        1082: pa.date32(), 1114: pa.timestamp("us"), 1184: pa.timestamp("us", tz="UTC"),
+    }
+    return pa.field(column.name, arrow_types.get(column.type_code, pa.string()))
+
+def _arrow_values(values, field):
+    if pa.types.is_floating(field.type):
+        return pa.array([None if v is None else float(v) for v in values], type=field.type)
+    if pa.types.is_string(field.type):
+        return pa.array([None if v is None else str(v) for v in values], type=field.type)
+    return pa.array(values, type=field.type)
+
+def _cursor_batches(conn, query):
+    with conn.connection.cursor(name=f"export_{uuid.uuid4().hex[:8]}") as cur:
+        cur.itersize = EXPORT_BATCH_ROWS
+        cur.execute(query)
+        rows = cur.fetchmany(EXPORT_BATCH_ROWS)
+        # Con i cursori server-side description è disponibile solo dopo il primo fetch
+        schema = pa.schema([_arrow_field(column) for column in cur.description])
+        while True:
+            columns = list(zip(*rows)) if rows else [[] for _ in schema]
+            yield pa.Table.from_arrays([_arrow_values(values, field) for values, field in zip(columns, schema)], schema=schema)
+            rows = cur.fetchmany(EXPORT_BATCH_ROWS)
+            if not rows:
+                break
+
+def _remove_export(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _cleanup_exports():
+    """Elimina gli export (e i .part rimasti da export interrotti) più vecchi di EXPORT_TTL_MINUTES"""
+    cutoff = datetime.datetime.now().timestamp() - EXPORT_TTL_MINUTES * 60
+    for entry in os.scandir(EXPORT_DIR):
+        if entry.is_file() and not entry.name.startswith(".") and entry.stat().st_mtime < cutoff:
+            _remove_export(entry.path)
+
+def render_export_controls(query, audit_module, key, confirmed=False):
+    """Export del risultato della Sandbox senza materializzarlo in un DataFrame, con lo stesso pre-flight della Run"""
+    if not SANDBOX_ENABLED:
+        # COPY TO STDOUT e cursori server-side sono specifici di PostgreSQL
+        st.caption("📥 Export disponibile solo con database PostgreSQL.")
+        return
+    formats = ["CSV", "Parquet"] if pq is not None else ["CSV"]
+    col_format, col_button = st.columns(2)
+    with col_format:
+        export_format = st.radio("Formato export:", formats, horizontal=True, key=f"export_format_{key}")
+    with col_button:
+        start_export = st.button("📥 Prepara Export", key=f"export_{key}")
+    if not start_export:
+        return
+    if WRITE_KEYWORDS.search(_strip_literals(query)):
+        st.warning("⚠️ L'export è disponibile solo per query di lettura (SELECT / WITH).")
+        return
+    extension = export_format.lower()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    _cleanup_exports()
+    # Un solo export per sessione: quello precedente non serve più
+    previous = st.session_state.pop("export_file", None)
+    if previous:
+        _remove_export(previous)
+    file_name = f"{uuid.uuid4().hex}.{extension}"
+    path = os.path.join(EXPORT_DIR, file_name)
+    progress = None
+    try:
+        rejection = preflight_check(query, confirmed)
+        if rejection:
+            write_audit_log(st.session_state.username, audit_module, f"EXPORT {export_format}: {query}", "REJECTED")
+            st.warning(rejection)
+            return
+        progress = st.progress(0.0, text="⏳ Export in corso...")
+        # Scrittura su .part e rename finale: il link punta solo a file completi
+        with open(path + ".part", "wb") as target:
+            if export_format == "CSV":
+                _export_csv(query, target, progress)
+            else:
+                _export_parquet(query, target, progress)
+            size_mb = target.tell() / 1024 / 1024
+        os.replace(path + ".part", path)
+        write_audit_log(st.session_state.username, audit_module, f"EXPORT {export_format}: {query}", "SUCCESS")
+    except Exception as e:
+        _remove_export(path + ".part")
+        write_audit_log(st.session_state.username, audit_module, f"EXPORT {export_format}: {query}", "ERROR")
+        if progress is not None:
+            progress.empty()
+        st.error(f"❌ Errore durante l'export: {e}")
+        return
+    st.session_state.export_file = path
+    progress.progress(1.0, text=f"✅ Export pronto ({size_mb:,.1f} MB).")
+    st.markdown(
+        f'<a href="app/static/exports/{file_name}" download="sandbox_export.{extension}">💾 Scarica file</a> '
+        f"(disponibile per {EXPORT_TTL_MINUTES:,.0f} minuti)",
+        unsafe_allow_html=True,
+    )
+
+def _quote_columns(columns):
+    return ", ".join(f'"{c}"' for c in columns)
+
+class MergeKeyError(Exception):
+    """Chiavi di merge non utilizzabili sulla tabella di destinazione (merge rifiutato, non fallito)"""
+
+def _check_merge_keys(conn, schema, table_name, key_columns, key_index):
+    """Verifica preventiva delle chiavi di merge: meglio un messaggio chiaro che l'errore SQL del CREATE UNIQUE INDEX"""
+    target = f'"{schema}"."{table_name}"' if schema else f'"{table_name}"'
+    relkind = conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"), {"name": target}).scalar()
+    if relkind == "p":
+        # Su una tabella partizionata l'indice univoco deve contenere la colonna di partizione
+        partition_column = PARTITIONED_TABLES.get(table_name, (None,))[0]
+        if partition_column not in key_columns:
+            raise MergeKeyError(
+                f"'{table_name}' nella tua sandbox è partizionata per {partition_column}: "
+                f"aggiungi {partition_column} alle colonne chiave oppure reimporta la tabella in modalità replace."
+            )
+    index_name = f'"{schema}"."{key_index}"' if schema else f'"{key_index}"'
+    if conn.execute(text("SELECT to_regclass(:name)"), {"name": index_name}).scalar() is not None:
+        return
+    duplicated = conn.execute(text(f'''
+        SELECT {_quote_columns(key_columns)} FROM {target}
+        GROUP BY {_quote_columns(key_columns)} HAVING COUNT(*) > 1 LIMIT 1
+    ''')).first()
+    if duplicated is not None:
+        keys = ", ".join(f"{c}={v}" for c, v in zip(key_columns, duplicated))
+        raise MergeKeyError(
+            f"'{table_name}' contiene già righe duplicate sulle chiavi scelte (es. {keys}): "
+            "scegli colonne chiave che identificano univocamente un record."
+        )
+
+def _csv_structure(csv_file):
+    """DataFrame vuoto con i tipi dedotti da tutto il CSV, letto a blocchi senza tenerlo in memoria:
+    un float o un testo oltre le prime righe allarga il tipo della colonna"""
+    dtypes = {}
+    for chunk in pd.read_csv(csv_file, chunksize=100_000):
+        for column, dtype in chunk.dtypes.items():
+            previous = dtypes.setdefault(column, dtype)
+            if previous == dtype:
+                continue
+            numeric = all(pd.api.types.is_numeric_dtype(t) and not pd.api.types.is_bool_dtype(t) for t in (previous, dtype))
+            dtypes[column] = "float64" if numeric else "object"
+    csv_file.seek(0)
+    return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in dtypes.items()})
+
+def merge_import(csv_file, table_name, key_columns):
+    """Import incrementale nella sandbox personale: COPY del CSV in una staging UNLOGGED e merge con
+    INSERT ... ON CONFLICT DO UPDATE. Vengono toccate solo le righe nuove o cambiate; restituisce (inserite, aggiornate, invariate)."""
+    columns = list(pd.read_csv(csv_file, nrows=0).columns)
+    csv_file.seek(0)
+    value_columns = [c for c in columns if c not in key_columns]
+    schema = st.session_state.sandbox_schema
+    target = f'"{schema}"."{table_name}"'
+    staging = f'"{schema}"."STG_{table_name}_{uuid.uuid4().hex[:8]}"'
+    key_index = f"{table_name}_{'_'.join(key_columns)}_KEY"[:63]
+    with sandbox_connection() as conn:
+        if table_name in SHARED_SAP_TABLES:
+            copy_on_write(conn, schema, [table_name])
+        if conn.execute(text("SELECT to_regclass(:name)"), {"name": target}).scalar() is None:
+            # Prima importazione: struttura dedotta da tutto il CSV, non solo dalle prime righe
+            _csv_structure(csv_file).to_sql(table_name, conn, schema=schema, index=False)
+        target_types = dict(conn.execute(text("""
+            SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = to_regclass(:name) AND attnum > 0 AND NOT attisdropped
+        """), {"name": target}).all())
+        missing = [c for c in columns if c not in target_types]
+        if missing:
+            raise ValueError(f"colonne del CSV assenti in '{table_name}': {', '.join(missing)}")
+        _check_merge_keys(conn, schema, table_name, key_columns, key_index)
+        # ON CONFLICT richiede un indice univoco sulle chiavi scelte (idempotente tra un import e l'altro)
+        conn.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS "{key_index}" ON {target} ({_quote_columns(key_columns)})'))
+        # Staging tutta TEXT: il COPY non fallisce mai a metà sui tipi, la conversione avviene nel merge
+        staging_columns = ", ".join(f'"{c}" TEXT' for c in columns)
+        conn.execute(text(f'CREATE UNLOGGED TABLE {staging} ({staging_columns})'))
+        with conn.connection.cursor() as cur:
+            cur.copy_expert(f'COPY {staging} ({_quote_columns(columns)}) FROM STDIN WITH (FORMAT csv, HEADER true)', csv_file)
+        if value_columns:
+            set_sql = ", ".join(f'"{c}" = EXCLUDED."{c}"' for c in value_columns)
+            target_values = ", ".join(f'tgt."{c}"' for c in value_columns)
+            excluded_values = ", ".join(f'EXCLUDED."{c}"' for c in value_columns)
+            conflict_sql = f"DO UPDATE SET {set_sql} WHERE ({target_values}) IS DISTINCT FROM ({excluded_values})"
+        else:
+            conflict_sql = "DO NOTHING"
+        # Cast ai tipi della tabella prima del DISTINCT ON (es. '01' e '1' sono la stessa chiave intera);
+        # se il CSV ripete una chiave vince l'ultima occorrenza
+        typed_columns = ", ".join(f'"{c}"::{target_types[c]} AS "{c}"' for c in columns)
+        try:
+            counts = conn.execute(text(f'''
+                WITH typed AS (
+                    SELECT {typed_columns}, ctid AS "STG_CTID" FROM {staging}
+                ), src AS (
+                    SELECT DISTINCT ON ({_quote_columns(key_columns)}) {_quote_columns(columns)}
+                    FROM typed ORDER BY {_quote_columns(key_columns)}, "STG_CTID" DESC
+                ), merged AS (
+                    INSERT INTO {target} AS tgt ({_quote_columns(columns)})
+                    SELECT {_quote_columns(columns)} FROM src
+                    ON CONFLICT ({_quote_columns(key_columns)}) {conflict_sql}
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT (SELECT COUNT(*) FROM src), COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted)
+                FROM merged
+            ''')).one()
+        except DataError as e:
+            # Nessuna riga applicata (stessa transazione): messaggio leggibile invece dell'errore di cast grezzo
+            raise ValueError(f"il CSV contiene valori non compatibili con i tipi di '{table_name}': {e.orig}") from e
+        conn.execute(text(f'DROP TABLE {staging}'))
+        conn.commit()
+    staged, inserted, updated = counts
+    return inserted, updated, staged - inserted - updated
+
 # Generazione ID Ospite Anonimo (Frictionless God Mode)
 if 'username' not in st.session_state:
     st.session_state.username = f"GUEST_{random.randint(1000, 9999)}"
+if 'sandbox_schema' not in st.session_state:
+    try:
+        st.session_state.sandbox_schema = ensure_sandbox(st.session_state.username)
+        st.session_state.sandbox_touched_at = datetime.datetime.now().timestamp()
+    except Exception as e:
+        # La sandbox non deve mai bloccare l'Academy: senza (es. niente CREATEROLE) si lavora in sola lettura sui dati condivisi
+        st.session_state.sandbox_schema = None
+        st.session_state.sandbox_error = str(e)
 
 # --- 3. STRUTTURA DELL'ACADEMY (SIDEBAR) ---
 with st.sidebar:
     st.image("https://upload.wikimedia.org/wikipedia/commons/thumb/5/59/SAP_2011_logo.svg/512px-SAP_2011_logo.svg.png", width=100)
     st.markdown("## 🎓 Executive SAP Academy")
     st.markdown(f"**Utente Connesso:** 🟢 `{st.session_state.username}`")
+    if st.session_state.get("sandbox_error"):
+        st.warning(f"⚠️ Sandbox personale non disponibile ({st.session_state.sandbox_error}): le tabelle S/4HANA condivise sono in sola lettura.")
     
     modulo = st.radio("Seleziona Ambiente:", [
         "MM - Procure to Pay", 
@@ -160,30 +852,25 @@ if modulo == "MM - Procure to Pay":
     with tab_pratica:
         st.markdown("### 💻 SQL Sandbox & Analytics Dashboard")
         user_query = st.text_area("Dialetto PostgreSQL (S/4HANA):", height=200, key="sandbox_mm", value="SELECT * FROM \"EKKO\" LIMIT 50;")
-        
+        confirm_costly = st.checkbox("Conferma esecuzione anche se oltre le soglie di costo", key="confirm_mm")
         if st.button("▶️ Esegui (Run)"):
             try:
-                with engine.connect() as conn:
-                    result_df = pd.read_sql(text(user_query), conn)
-                write_audit_log(st.session_state.username, "MM", user_query, "SUCCESS")
-                col_tab, col_chart = st.columns(2)
-                with col_tab:
-                    st.dataframe(result_df, use_container_width=True)
-                with col_chart:
-                    if len(result_df.columns) >= 2:
-                        col1_name = result_df.columns[0]
-                        col2_name = result_df.columns[1]
-                        if pd.api.types.is_numeric_dtype(result_df[col2_name]):
-                            st.markdown("**📊 SAC Story Mode**")
-                            chart_data = result_df.set_index(col1_name)
-                            st.bar_chart(chart_data[col2_name], color="#0A6ED1")
-                        else:
-                            st.info("💡 **SAC Hint:** Per generare un grafico a barre direzionale, assicurati che la tua query estragga una seconda colonna con valori numerici (es. SUM, COUNT). Due colonne di testo non possono generare KPI.")
-                    else:
-                        st.warning("⚠️ La tua query estrae solo una colonna. Estrai almeno due colonne (es. Fornitore e Spesa) per attivare i grafici automatici.")
+                rejection = preflight_check(user_query, confirm_costly)
+                if rejection:
+                    write_audit_log(st.session_state.username, "MM", user_query, "REJECTED")
+                    st.warning(rejection)
+                else:
+                    result = run_sandbox_query(user_query)
+                    write_audit_log(st.session_state.username, "MM", user_query, "SUCCESS")
+                    render_sandbox_result(
+                        result, "**📊 SAC Story Mode**", "#0A6ED1",
+                        "💡 **SAC Hint:** Per generare un grafico a barre direzionale, assicurati che la tua query estragga una seconda colonna con valori numerici (es. SUM, COUNT). Due colonne di testo non possono generare KPI.",
+                        "⚠️ La tua query estrae solo una colonna. Estrai almeno due colonne (es. Fornitore e Spesa) per attivare i grafici automatici.",
+                    )
             except Exception as e:
                 write_audit_log(st.session_state.username, "MM", user_query, "ERROR")
                 st.error(f"❌ Errore SQL: {e}")
+        render_export_controls(user_query, "MM", "mm", confirm_costly)
 
 # =========================================================================
 # MODULO: FI/CO FINANCIALS
@@ -236,29 +923,25 @@ elif modulo == "FI/CO - Financials":
     with tab_pratica:
         st.markdown("### 💻 SQL Sandbox & Analytics Dashboard")
         user_query = st.text_area("Dialetto PostgreSQL (S/4HANA):", height=200, key="sandbox_fi", value="SELECT * FROM \"BSEG\" LIMIT 50;")
+        confirm_costly = st.checkbox("Conferma esecuzione anche se oltre le soglie di costo", key="confirm_fi")
         if st.button("▶️ Esegui (Run)"):
             try:
-                with engine.connect() as conn:
-                    result_df = pd.read_sql(text(user_query), conn)
-                write_audit_log(st.session_state.username, "FI", user_query, "SUCCESS")
-                col_tab, col_chart = st.columns(2)
-                with col_tab:
-                    st.dataframe(result_df, use_container_width=True)
-                with col_chart:
-                    if len(result_df.columns) >= 2:
-                        col1_name = result_df.columns[0]
-                        col2_name = result_df.columns[1]
-                        if pd.api.types.is_numeric_dtype(result_df[col2_name]):
-                            st.markdown("**📊 SAC Story Mode**")
-                            chart_data = result_df.set_index(col1_name)
-                            st.bar_chart(chart_data[col2_name], color="#E74C3C")
-                        else:
-                            st.info("💡 **SAC Hint:** Estrai un valore numerico nella seconda colonna (es. Varianza, WRBTR) per generare il grafico degli scostamenti.")
-                    else:
-                        st.warning("⚠️ Estrai almeno due colonne per visualizzare l'analisi grafica.")
+                rejection = preflight_check(user_query, confirm_costly)
+                if rejection:
+                    write_audit_log(st.session_state.username, "FI", user_query, "REJECTED")
+                    st.warning(rejection)
+                else:
+                    result = run_sandbox_query(user_query)
+                    write_audit_log(st.session_state.username, "FI", user_query, "SUCCESS")
+                    render_sandbox_result(
+                        result, "**📊 SAC Story Mode**", "#E74C3C",
+                        "💡 **SAC Hint:** Estrai un valore numerico nella seconda colonna (es. Varianza, WRBTR) per generare il grafico degli scostamenti.",
+                        "⚠️ Estrai almeno due colonne per visualizzare l'analisi grafica.",
+                    )
             except Exception as e:
                 write_audit_log(st.session_state.username, "FI", user_query, "ERROR")
                 st.error(f"❌ Errore SQL: {e}")
+        render_export_controls(user_query, "FI", "fi", confirm_costly)
 
 # =========================================================================
 # MODULO: SD ORDER TO CASH
@@ -314,29 +997,25 @@ elif modulo == "SD - Order to Cash":
     with tab_pratica:
         st.markdown("### 💻 SQL Sandbox & Analytics Dashboard")
         user_query = st.text_area("Dialetto PostgreSQL (S/4HANA):", height=200, key="sandbox_sd", value="SELECT * FROM \"VBAK\" LIMIT 50;")
+        confirm_costly = st.checkbox("Conferma esecuzione anche se oltre le soglie di costo", key="confirm_sd")
         if st.button("▶️ Esegui (Run)"):
             try:
-                with engine.connect() as conn:
-                    result_df = pd.read_sql(text(user_query), conn)
-                write_audit_log(st.session_state.username, "SD", user_query, "SUCCESS")
-                col_tab, col_chart = st.columns(2)
-                with col_tab:
-                    st.dataframe(result_df, use_container_width=True)
-                with col_chart:
-                    if len(result_df.columns) >= 2:
-                        col1_name = result_df.columns[0]
-                        col2_name = result_df.columns[1]
-                        if pd.api.types.is_numeric_dtype(result_df[col2_name]):
-                            st.markdown("**📊 SAC Story Mode**")
-                            chart_data = result_df.set_index(col1_name)
-                            st.bar_chart(chart_data[col2_name], color="#2ECC71")
-                        else:
-                            st.info("💡 **SAC Hint:** Estrai i Ricavi o i Margini come seconda colonna per generare il grafico delle performance di vendita.")
-                    else:
-                        st.warning("⚠️ Estrai almeno due colonne (es. Cliente e Margine) per attivare la dashboard.")
+                rejection = preflight_check(user_query, confirm_costly)
+                if rejection:
+                    write_audit_log(st.session_state.username, "SD", user_query, "REJECTED")
+                    st.warning(rejection)
+                else:
+                    result = run_sandbox_query(user_query)
+                    write_audit_log(st.session_state.username, "SD", user_query, "SUCCESS")
+                    render_sandbox_result(
+                        result, "**📊 SAC Story Mode**", "#2ECC71",
+                        "💡 **SAC Hint:** Estrai i Ricavi o i Margini come seconda colonna per generare il grafico delle performance di vendita.",
+                        "⚠️ Estrai almeno due colonne (es. Cliente e Margine) per attivare la dashboard.",
+                    )
             except Exception as e:
                 write_audit_log(st.session_state.username, "SD", user_query, "ERROR")
                 st.error(f"❌ Errore SQL: {e}")
+        render_export_controls(user_query, "SD", "sd", confirm_costly)
 
 # =========================================================================
 # MODULO: PM/PP PLANT & PRODUCTION
@@ -393,29 +1072,25 @@ elif modulo == "PM/PP - Plant & Production":
     with tab_pratica:
         st.markdown("### 💻 SQL Sandbox & Analytics Dashboard")
         user_query = st.text_area("Dialetto PostgreSQL (S/4HANA):", height=200, key="sandbox_pm", value="SELECT * FROM \"EQUI\" LIMIT 50;")
+        confirm_costly = st.checkbox("Conferma esecuzione anche se oltre le soglie di costo", key="confirm_pm")
         if st.button("▶️ Esegui (Run)"):
             try:
-                with engine.connect() as conn:
-                    result_df = pd.read_sql(text(user_query), conn)
-                write_audit_log(st.session_state.username, "PM", user_query, "SUCCESS")
-                col_tab, col_chart = st.columns(2)
-                with col_tab:
-                    st.dataframe(result_df, use_container_width=True)
-                with col_chart:
-                    if len(result_df.columns) >= 2:
-                        col1_name = result_df.columns[0]
-                        col2_name = result_df.columns[1]
-                        if pd.api.types.is_numeric_dtype(result_df[col2_name]):
-                            st.markdown("**📊 SAC Story Mode**")
-                            chart_data = result_df.set_index(col1_name)
-                            st.bar_chart(chart_data[col2_name], color="#F39C12")
-                        else:
-                            st.info("💡 **SAC Hint:** Estrai il costo delle operazioni (es. COST_TOT) nella seconda colonna per generare il grafico dei costi di manutenzione.")
-                    else:
-                        st.warning("⚠️ Estrai almeno due colonne (es. Macchinario e Costo) per attivare la dashboard.")
+                rejection = preflight_check(user_query, confirm_costly)
+                if rejection:
+                    write_audit_log(st.session_state.username, "PM", user_query, "REJECTED")
+                    st.warning(rejection)
+                else:
+                    result = run_sandbox_query(user_query)
+                    write_audit_log(st.session_state.username, "PM", user_query, "SUCCESS")
+                    render_sandbox_result(
+                        result, "**📊 SAC Story Mode**", "#F39C12",
+                        "💡 **SAC Hint:** Estrai il costo delle operazioni (es. COST_TOT) nella seconda colonna per generare il grafico dei costi di manutenzione.",
+                        "⚠️ Estrai almeno due colonne (es. Macchinario e Costo) per attivare la dashboard.",
+                    )
             except Exception as e:
                 write_audit_log(st.session_state.username, "PM", user_query, "ERROR")
                 st.error(f"❌ Errore SQL: {e}")
+        render_export_controls(user_query, "PM", "pm", confirm_costly)
 
 # =========================================================================
 # MODULO: CYBER SECURITY (SM20 AUDIT LOG)
@@ -432,7 +1107,7 @@ elif modulo == "🛡️ Cyber Security (SM20)":
             df_logs = pd.read_sql(text(query_logs), conn)
         
         def color_status(val):
-            color = '#E74C3C' if val == 'ERROR' else '#2ECC71'
+            color = {'ERROR': '#E74C3C', 'REJECTED': '#F39C12'}.get(val, '#2ECC71')
             return f'color: {color}; font-weight: bold'
         
         st.dataframe(df_logs.style.map(color_status, subset=['STATUS']), use_container_width=True, hide_index=True)
@@ -445,7 +1120,10 @@ elif modulo == "🛡️ Cyber Security (SM20)":
 # =========================================================================
 elif modulo == "⚙️ Data Importer (CSV/Gemini)":
     st.title("⚙️ Data Importer & Custom Sandbox")
-    st.markdown("Usa questo spazio per caricare dataset esterni. Le tabelle verranno salvate nel tuo S/4HANA locale.")
+    if st.session_state.sandbox_schema is not None:
+        st.markdown(f"Usa questo spazio per caricare dataset esterni. Le tabelle verranno salvate nella tua sandbox personale (`{st.session_state.sandbox_schema}`): gli altri studenti continuano a vedere i dati S/4HANA originali.")
+    else:
+        st.markdown("Usa questo spazio per caricare dataset esterni. Le tabelle verranno salvate nel tuo S/4HANA locale.")
     
     st.info("💡 **Vuoi generare un dataset fittizio all'istante?** Clicca sul pulsante qui sotto per aprire Gemini, chiedigli di generare una tabella dati per SAP in formato CSV, salvala sul tuo PC e caricala qui!")
     st.link_button("🧠 Apri Gemini in una nuova scheda", "https://gemini.google.com")
@@ -454,42 +1132,71 @@ elif modulo == "⚙️ Data Importer (CSV/Gemini)":
     
     uploaded_file = st.file_uploader("Carica il tuo file CSV", type=["csv"])
     table_name_input = st.text_input("Nome della tabella da creare (es. Z_MY_TABLE):", "Z_CUSTOM_TABLE")
+    import_modes = ["Sostituisci tabella (replace)", "Merge su colonne chiave (upsert)"] if st.session_state.sandbox_schema is not None else ["Sostituisci tabella (replace)"]
+    import_mode = st.radio("Modalità di import:", import_modes, horizontal=True)
+    key_columns = []
+    if uploaded_file is not None and import_mode.startswith("Merge"):
+        csv_columns = list(pd.read_csv(uploaded_file, nrows=0).columns)
+        uploaded_file.seek(0)
+        key_columns = st.multiselect("Colonne chiave (identificano univocamente un record):", csv_columns)
     
     if uploaded_file is not None and st.button("☁️ Carica su Database"):
-        try:
-            df_upload = pd.read_csv(uploaded_file)
-            df_upload.to_sql(table_name_input.upper(), engine, if_exists='replace', index=False)
-            write_audit_log(st.session_state.username, "IMPORTER", f"CREATE TABLE {table_name_input.upper()}", "SUCCESS")
-            st.success(f"✅ Tabella '{table_name_input.upper()}' creata con successo! ({len(df_upload)} record).")
-            st.dataframe(df_upload.head(3))
-        except Exception as e:
-            write_audit_log(st.session_state.username, "IMPORTER", f"Tentativo UPLOAD Tabella {table_name_input.upper()} FALLITO", "ERROR")
-            st.error(f"❌ Errore durante il caricamento: {e}")
+        target_table = table_name_input.upper()
+        if import_mode.startswith("Merge"):
+            if not key_columns:
+                st.warning("⚠️ Seleziona almeno una colonna chiave per il merge.")
+            else:
+                try:
+                    inserted, updated, unchanged = merge_import(uploaded_file, target_table, key_columns)
+                    write_audit_log(st.session_state.username, "IMPORTER", f"MERGE INTO {target_table} ON ({', '.join(key_columns)})", "SUCCESS")
+                    st.success(f"✅ Merge su '{target_table}' completato: {inserted} inseriti, {updated} aggiornati, {unchanged} invariati.")
+                except MergeKeyError as e:
+                    write_audit_log(st.session_state.username, "IMPORTER", f"Tentativo MERGE Tabella {target_table} RIFIUTATO", "REJECTED")
+                    st.warning(f"⚠️ Merge non eseguibile: {e}")
+                except Exception as e:
+                    write_audit_log(st.session_state.username, "IMPORTER", f"Tentativo MERGE Tabella {target_table} FALLITO", "ERROR")
+                    st.error(f"❌ Errore durante il merge: {e}")
+        elif SANDBOX_ENABLED and st.session_state.sandbox_schema is None and target_table in SHARED_SAP_TABLES | PROTECTED_TABLES:
+            write_audit_log(st.session_state.username, "IMPORTER", f"Tentativo UPLOAD Tabella {target_table} RIFIUTATO", "REJECTED")
+            st.warning(f"⚠️ Sandbox personale non disponibile: '{target_table}' è condivisa e non può essere sostituita.")
+        else:
+            try:
+                df_upload = pd.read_csv(uploaded_file)
+                schema = st.session_state.sandbox_schema
+                with sandbox_connection() as conn:
+                    if schema is not None and target_table in PARTITIONED_TABLES and PARTITIONED_TABLES[target_table][0] in df_upload.columns:
+                        # Tabelle partizionate (BKPF/BSEG, EKKO, VBAK, AFIH): le righe vengono instradate per anno/mese
+                        write_partitioned(df_upload, target_table, conn, schema=schema)
+                    else:
+                        df_upload.to_sql(target_table, conn, schema=schema, if_exists='replace', index=False)
+                    conn.commit()
+                write_audit_log(st.session_state.username, "IMPORTER", f"CREATE TABLE {target_table}", "SUCCESS")
+                st.success(f"✅ Tabella '{target_table}' creata con successo! ({len(df_upload)} record).")
+                st.dataframe(df_upload.head(3))
+            except Exception as e:
+                write_audit_log(st.session_state.username, "IMPORTER", f"Tentativo UPLOAD Tabella {target_table} FALLITO", "ERROR")
+                st.error(f"❌ Errore durante il caricamento: {e}")
             
     st.markdown("---")
     st.markdown("### 💻 Custom SQL Sandbox")
     st.write("Interroga le tabelle custom che hai appena caricato.")
     custom_query = st.text_area("SQL Query:", height=150, value=f"SELECT * FROM \"{table_name_input.upper()}\" LIMIT 10;")
+    confirm_costly = st.checkbox("Conferma esecuzione anche se oltre le soglie di costo", key="confirm_importer")
     if st.button("▶️ Esegui Query (F8)"):
         try:
-            with engine.connect() as conn:
-                res_df = pd.read_sql(text(custom_query), conn)
-            write_audit_log(st.session_state.username, "IMPORTER Sandbox", custom_query, "SUCCESS")
-            col_tab, col_chart = st.columns(2)
-            with col_tab:
-                st.dataframe(res_df, use_container_width=True)
-            with col_chart:
-                if len(res_df.columns) >= 2:
-                    col1_name = res_df.columns[0]
-                    col2_name = res_df.columns[1]
-                    if pd.api.types.is_numeric_dtype(res_df[col2_name]):
-                        st.markdown("**📊 Preview**")
-                        chart_data = res_df.set_index(col1_name)
-                        st.bar_chart(chart_data[col2_name])
-                    else:
-                        st.info("💡 Se la tua tabella custom ha un valore numerico nella seconda colonna, verrà generato un grafico in automatico.")
-                else:
-                    st.warning("⚠️ La tua query estrae solo una colonna. Estrai almeno due colonne per abilitare i grafici.")
+            rejection = preflight_check(custom_query, confirm_costly)
+            if rejection:
+                write_audit_log(st.session_state.username, "IMPORTER Sandbox", custom_query, "REJECTED")
+                st.warning(rejection)
+            else:
+                res = run_sandbox_query(custom_query)
+                write_audit_log(st.session_state.username, "IMPORTER Sandbox", custom_query, "SUCCESS")
+                render_sandbox_result(
+                    res, "**📊 Preview**", None,
+                    "💡 Se la tua tabella custom ha un valore numerico nella seconda colonna, verrà generato un grafico in automatico.",
+                    "⚠️ La tua query estrae solo una colonna. Estrai almeno due colonne per abilitare i grafici.",
+                )
         except Exception as e:
             write_audit_log(st.session_state.username, "IMPORTER Sandbox", custom_query, "ERROR")
-            st.error(f"❌ Errore SQL: {e}")
\ No newline at end of file
+            st.error(f"❌ Errore SQL: {e}")
+    render_export_controls(custom_query, "IMPORTER Sandbox", "importer", confirm_costly)
\ No newline at end of file
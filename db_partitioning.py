@@ -0,0 +1,92 @@
+import datetime
+from contextlib import nullcontext
+import pandas as pd
+from sqlalchemy import Engine, text
+
+# Tabelle S/4HANA partizionate dichiarativamente (PostgreSQL):
+# - FI: BKPF/BSEG per esercizio contabile (GJAHR, LIST)
+# - Transazionali: partizioni mensili sulla data documento (RANGE)
+PARTITIONED_TABLES = {
+    'BKPF': ('GJAHR', 'year'),
+    'BSEG': ('GJAHR', 'year'),
+    'EKKO': ('AEDAT', 'month'),
+    'VBAK': ('AUDAT', 'month'),
+    'AFIH': ('ERDAT', 'month'),
+}
+
+
+def _qualified(name, schema=None):
+    return f'"{schema}"."{name}"' if schema else f'"{name}"'
+
+
+def _partition_name(table_name, key):
+    if isinstance(key, datetime.date):
+        return f"{table_name}_{key.strftime('%Y_%m')}"
+    return f"{table_name}_{key}"
+
+
+def _month_start(value):
+    value = pd.to_datetime(value)
+    return datetime.date(value.year, value.month, 1)
+
+
+def _partition_keys(table_name, values):
+    """Chiavi di partizione distinte presenti nei dati (anni o primi giorni del mese)"""
+    _, granularity = PARTITIONED_TABLES[table_name]
+    values = pd.Series(values).dropna()
+    if granularity == 'year':
+        return sorted({int(v) for v in values})
+    return sorted({_month_start(v) for v in values})
+
+
+def create_partitioned_table(conn, table_name, columns_sql, schema=None):
+    """Ricrea la tabella madre partizionata (con partizione DEFAULT per i record fuori range)"""
+    column, granularity = PARTITIONED_TABLES[table_name]
+    strategy = 'LIST' if granularity == 'year' else 'RANGE'
+    parent = _qualified(table_name, schema)
+    # Niente CASCADE: come to_sql(replace), se altri oggetti dipendono dalla tabella l'errore deve emergere
+    # (le partizioni figlie vengono comunque eliminate insieme alla madre)
+    conn.execute(text(f'DROP TABLE IF EXISTS {parent}'))
+    conn.execute(text(f'CREATE TABLE {parent} ({columns_sql}) PARTITION BY {strategy} ("{column}")'))
+    conn.execute(text(f'CREATE TABLE {_qualified(table_name + "_DEFAULT", schema)} PARTITION OF {parent} DEFAULT'))
+
+
+def ensure_partitions(conn, table_name, values, schema=None):
+    """Crea (se mancanti) le partizioni che ospiteranno i valori indicati"""
+    column, granularity = PARTITIONED_TABLES[table_name]
+    parent = _qualified(table_name, schema)
+    for key in _partition_keys(table_name, values):
+        partition = _qualified(_partition_name(table_name, key), schema)
+        exists = conn.execute(text("SELECT to_regclass(:name)"), {'name': partition}).scalar()
+        if exists is not None:
+            continue
+        if granularity == 'year':
+            bounds = f"FOR VALUES IN ({key})"
+            match_sql = f'"{column}" = {key}'
+        else:
+            next_month = (key + datetime.timedelta(days=32)).replace(day=1)
+            bounds = f"FOR VALUES FROM ('{key}') TO ('{next_month}')"
+            match_sql = f'"{column}" >= \'{key}\' AND "{column}" < \'{next_month}\''
+        # Righe già finite nella DEFAULT impedirebbero l'ATTACH: le spostiamo nella nuova partizione
+        conn.execute(text(f'CREATE TABLE {partition} (LIKE {parent} INCLUDING DEFAULTS)'))
+        conn.execute(text(f'''
+            WITH moved AS (DELETE FROM {_qualified(table_name + "_DEFAULT", schema)} WHERE {match_sql} RETURNING *)
+            INSERT INTO {partition} SELECT * FROM moved
+        '''))
+        conn.execute(text(f'ALTER TABLE {parent} ATTACH PARTITION {partition} {bounds}'))
+
+
+def write_partitioned(df, table_name, connectable, if_exists='replace', schema=None):
+    """Scrive un DataFrame su una tabella partizionata: PostgreSQL instrada ogni riga nella partizione giusta.
+    Accetta un Engine (transazione propria) o una Connection già aperta (es. quella della Sandbox)."""
+    column, _ = PARTITIONED_TABLES[table_name]
+    transaction = connectable.begin() if isinstance(connectable, Engine) else nullcontext(connectable)
+    with transaction as conn:
+        exists = conn.execute(text("SELECT to_regclass(:name)"), {'name': _qualified(table_name, schema)}).scalar()
+        if if_exists == 'replace' or exists is None:
+            # Riusiamo la mappatura dei tipi di pandas per le colonne, aggiungendo solo la clausola PARTITION BY
+            schema_sql = pd.io.sql.get_schema(df, table_name, con=conn)
+            columns_sql = schema_sql[schema_sql.index('(') + 1:schema_sql.rindex(')')]
+            create_partitioned_table(conn, table_name, columns_sql, schema)
+        ensure_partitions(conn, table_name, df[column], schema)
+        df.to_sql(table_name, conn, schema=schema, if_exists='append', index=False)
@@ -4,6 +4,7 @@ from faker import Faker
 import random
 from sqlalchemy import create_engine
 from dotenv import load_dotenv
+from db_partitioning import write_partitioned
 
 # 1. Configurazione Connessione S/4HANA CLOUD
 load_dotenv()
@@ -95,12 +96,12 @@ for index, row in df_ekko.iterrows():
         'EBELP': None
     })
 
-# 4. Scrittura massiva su PostgreSQL
+# 4. Scrittura massiva su PostgreSQL (tabelle partizionate per esercizio GJAHR)
 df_bkpf = pd.DataFrame(bkpf_records)
 df_bseg = pd.DataFrame(bseg_records)
 
-df_bkpf.to_sql('BKPF', engine, if_exists='replace', index=False)
-df_bseg.to_sql('BSEG', engine, if_exists='replace', index=False)
+write_partitioned(df_bkpf, 'BKPF', engine)
+write_partitioned(df_bseg, 'BSEG', engine)
 
 print(f"✅ Tabella BKPF (Testate Contabili): {len(df_bkpf)} record.")
 print(f"✅ Tabella BSEG (Posizioni Contabili): {len(df_bseg)} record.")
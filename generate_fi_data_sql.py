@@ -0,0 +1,88 @@
+import os
+from sqlalchemy import create_engine, text
+from dotenv import load_dotenv
+from db_partitioning import create_partitioned_table, ensure_partitions
+
+# 1. Configurazione Connessione S/4HANA CLOUD
+load_dotenv()
+db_url = os.getenv("DATABASE_URL")
+engine = create_engine(db_url)
+
+# Seed di random() lato PostgreSQL (setseed vuole un valore tra -1 e 1): stesso seed = stesse varianze
+fi_seed = float(os.getenv("FI_SEED", "0.42"))
+
+print("🚀 Avvio Motore Finanziario (FI/CO) In-Database - Generazione MIRO set-based...")
+
+# Stesso tracciato del motore pandas (generate_fi_data.py), ma dichiarato esplicitamente
+BKPF_COLUMNS = '"BUKRS" TEXT, "BELNR" TEXT, "GJAHR" BIGINT, "BLART" TEXT, "BLDAT" DATE, "BUDAT" DATE, "AWKEY" TEXT'
+BSEG_COLUMNS = ('"BUKRS" TEXT, "BELNR" TEXT, "GJAHR" BIGINT, "BUZEI" BIGINT, "BSCHL" TEXT, "HKONT" TEXT, '
+                '"SHKZG" TEXT, "WRBTR" DOUBLE PRECISION, "EBELN" TEXT, "EBELP" BIGINT')
+
+with engine.begin() as conn:
+    conn.execute(text("SELECT setseed(:seed)"), {'seed': fi_seed})
+
+    # 2. Testate: un documento per ordine, BELNR progressivo da 1900000000 e fattura 5-30 giorni dopo l'ordine
+    print("⏳ Numerazione Documenti Contabili (BELNR) via window function...")
+    conn.execute(text('''
+        CREATE TEMP TABLE fi_docs ON COMMIT DROP AS
+        SELECT
+            ekko."EBELN",
+            ekko."LIFNR",
+            (1900000000 + ROW_NUMBER() OVER (ORDER BY ekko."EBELN") - 1)::text AS "BELNR",
+            ekko."AEDAT"::date + (5 + floor(random() * 26))::int AS "BUDAT"
+        FROM "EKKO" ekko
+    '''))
+
+    # 3. Righe Dare: BUZEI con ROW_NUMBER (la riga 1 è riservata al fornitore), 20% di scostamenti -10%/+15%
+    print("⏳ Generazione Posizioni Dare con iniezione scostamenti...")
+    conn.execute(text('''
+        CREATE TEMP TABLE fi_lines ON COMMIT DROP AS
+        SELECT
+            d."BELNR",
+            EXTRACT(YEAR FROM d."BUDAT")::bigint AS "GJAHR",
+            ROW_NUMBER() OVER (PARTITION BY d."BELNR" ORDER BY ekpo."EBELP") + 1 AS "BUZEI",
+            CASE WHEN random() < 0.20
+                 THEN round((ekpo."NETWR" * (0.90 + random() * 0.25))::numeric, 2)::double precision
+                 ELSE ekpo."NETWR"
+            END AS "WRBTR",
+            ekpo."EBELN",
+            ekpo."EBELP"
+        FROM fi_docs d
+        JOIN "EKPO" ekpo ON ekpo."EBELN" = d."EBELN"
+    '''))
+
+    # 4. Tabelle partizionate per esercizio: creiamo solo le partizioni degli anni presenti
+    create_partitioned_table(conn, 'BKPF', BKPF_COLUMNS)
+    create_partitioned_table(conn, 'BSEG', BSEG_COLUMNS)
+    years = conn.execute(text('SELECT DISTINCT EXTRACT(YEAR FROM "BUDAT")::int FROM fi_docs')).scalars().all()
+    ensure_partitions(conn, 'BKPF', years)
+    ensure_partitions(conn, 'BSEG', years)
+
+    print("⏳ Scrittura BKPF/BSEG con INSERT ... SELECT (nessun dato lascia il server)...")
+    conn.execute(text('''
+        INSERT INTO "BKPF" ("BUKRS", "BELNR", "GJAHR", "BLART", "BLDAT", "BUDAT", "AWKEY")
+        SELECT '1000', "BELNR", EXTRACT(YEAR FROM "BUDAT")::bigint, 'RE', "BUDAT", "BUDAT", "EBELN"
+        FROM fi_docs
+    '''))
+    conn.execute(text('''
+        INSERT INTO "BSEG" ("BUKRS", "BELNR", "GJAHR", "BUZEI", "BSCHL", "HKONT", "SHKZG", "WRBTR", "EBELN", "EBELP")
+        SELECT '1000', "BELNR", "GJAHR", "BUZEI", '86', '400000', 'S', "WRBTR", "EBELN", "EBELP"
+        FROM fi_lines
+    '''))
+    # Riga Avere (Debito verso Fornitore): totale fattura aggregato per documento
+    conn.execute(text('''
+        INSERT INTO "BSEG" ("BUKRS", "BELNR", "GJAHR", "BUZEI", "BSCHL", "HKONT", "SHKZG", "WRBTR", "EBELN", "EBELP")
+        SELECT
+            '1000', d."BELNR", EXTRACT(YEAR FROM d."BUDAT")::bigint, 1, '31', d."LIFNR", 'H',
+            round(COALESCE(SUM(l."WRBTR"), 0)::numeric, 2)::double precision, NULL, NULL
+        FROM fi_docs d
+        LEFT JOIN fi_lines l ON l."BELNR" = d."BELNR"
+        GROUP BY d."BELNR", d."LIFNR", d."BUDAT"
+    '''))
+
+    num_bkpf = conn.execute(text('SELECT COUNT(*) FROM "BKPF"')).scalar()
+    num_bseg = conn.execute(text('SELECT COUNT(*) FROM "BSEG"')).scalar()
+
+print(f"✅ Tabella BKPF (Testate Contabili): {num_bkpf} record.")
+print(f"✅ Tabella BSEG (Posizioni Contabili): {num_bseg} record.")
+print("🎯 Boom! Modulo FI/CO alimentato in-database. Il 3-Way Match MM-FI è completo.")
@@ -4,6 +4,7 @@ from faker import Faker
 import random
 from sqlalchemy import create_engine
 from dotenv import load_dotenv
+from db_partitioning import write_partitioned
 
 # 1. Configurazione Connessione S/4HANA CLOUD
 load_dotenv()
@@ -47,7 +48,7 @@ for i in range(num_orders):
         'AEDAT': fake.date_between(start_date='-2y', end_date='today') # Dati di 2 anni per fare analisi
     })
 df_ekko = pd.DataFrame(orders)
-df_ekko.to_sql('EKKO', engine, if_exists='replace', index=False)
+write_partitioned(df_ekko, 'EKKO', engine)
 
 # 4. Generazione EKPO (Posizioni Ordini - NUOVO)
 print("⏳ Generazione EKPO (Posizioni Ordini)...")
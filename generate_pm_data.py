@@ -4,6 +4,7 @@ from faker import Faker
 import random
 from sqlalchemy import create_engine
 from dotenv import load_dotenv
+from db_partitioning import write_partitioned
 
 # 1. Configurazione Connessione S/4HANA CLOUD
 load_dotenv()
@@ -55,7 +56,7 @@ for i in range(250):
         'ERDAT': fake.date_between(start_date='-1y', end_date='today')
     })
 df_afih = pd.DataFrame(pm_orders)
-df_afih.to_sql('AFIH', engine, if_exists='replace', index=False)
+write_partitioned(df_afih, 'AFIH', engine)
 
 # 5. Generazione AFVC (Operazioni e Costi dell'Ordine)
 print("⏳ Generazione Operazioni e Costi (AFVC)...")
@@ -4,6 +4,7 @@ from faker import Faker
 import random
 from sqlalchemy import create_engine
 from dotenv import load_dotenv
+from db_partitioning import write_partitioned
 
 # 1. Configurazione Connessione S/4HANA CLOUD
 load_dotenv()
@@ -46,7 +47,7 @@ for i in range(num_sales_orders):
         'AUDAT': fake.date_between(start_date='-1y', end_date='today')
     })
 df_vbak = pd.DataFrame(sales_orders)
-df_vbak.to_sql('VBAK', engine, if_exists='replace', index=False)
+write_partitioned(df_vbak, 'VBAK', engine)
 
 # 4. Generazione VBAP (Posizioni Ordini di Vendita)
 print("⏳ Generazione Posizioni Ordini (VBAP)...")
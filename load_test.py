@@ -0,0 +1,252 @@
+import os
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from sqlalchemy import create_engine, text
+from dotenv import load_dotenv
+from streamlit.testing.v1 import AppTest
+
+# Harness di carico: N studenti "headless" che usano app.py in parallelo tramite l'API di test di Streamlit.
+# Esempio: python load_test.py --sessions 20 --actions 30 --seed 42 --output run.json --baseline prev.json
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+MODULES = {
+    "MM - Procure to Pay": ("sandbox_mm", 'SELECT "EBELN", "LIFNR", "AEDAT" FROM "EKKO" LIMIT 50;'),
+    "FI/CO - Financials": ("sandbox_fi", 'SELECT "BELNR", SUM("WRBTR") FROM "BSEG" GROUP BY "BELNR" LIMIT 50;'),
+    "SD - Order to Cash": ("sandbox_sd", 'SELECT "KUNNR", COUNT(*) FROM "VBAK" GROUP BY "KUNNR";'),
+    "PM/PP - Plant & Production": ("sandbox_pm", 'SELECT "EQUNR", COUNT(*) FROM "AFIH" GROUP BY "EQUNR";'),
+}
+IMPORTER = "⚙️ Data Importer (CSV/Gemini)"
+AUDIT = "🛡️ Cyber Security (SM20)"
+
+# Mix realistico di una lezione: molte letture di manuale/dizionario, meno query e pochissimi import
+ACTION_WEIGHTS = {
+    "module_switch": 30,   # cambio modulo: renderizza Handbook + Data Dictionary (get_table_schema)
+    "sandbox_query": 35,   # esecuzione di una query della Sandbox (pre-flight + fetch + grafico)
+    "audit_view": 15,      # consultazione SM20
+    "importer_query": 10,  # Custom SQL Sandbox sulle tabelle Z_
+    "csv_import": 10,      # carico sintetico di scrittura (vedi SessionDriver.csv_import)
+}
+# Azioni che non passano dal codice di app.py: generano carico sul DB ma restano fuori dal report di latenza
+SYNTHETIC_ACTIONS = {"csv_import"}
+
+
+class SessionDriver:
+    """Una sessione studente: un AppTest indipendente con il proprio session_state"""
+
+    def __init__(self, session_id, database_url, timeout, engine, username=None):
+        self.session_id = session_id
+        self.database_url = database_url
+        self.timeout = timeout
+        self.at = AppTest.from_file(APP_FILE, default_timeout=timeout)
+        self.at.secrets["DATABASE_URL"] = database_url
+        self.at.session_state["username"] = username or f"LOADTEST_{session_id:04d}"
+        self.at.run()
+        # La tabella letta da importer_query esiste da subito: le latenze non dipendono dall'ordine delle azioni
+        self.csv_import(random.Random(session_id), engine)
+
+    def _goto(self, modulo):
+        self.at.radio(key="menu_moduli").set_value(modulo).run()
+
+    def _check(self):
+        if self.at.exception:
+            raise RuntimeError(self.at.exception[0].message)
+
+    def module_switch(self, rng):
+        self._goto(rng.choice(list(MODULES)))
+        self._check()
+
+    def sandbox_query(self, rng):
+        modulo = rng.choice(list(MODULES))
+        key, query = MODULES[modulo]
+        self._goto(modulo)
+        self.at.text_area(key=key).input(query)
+        self.at.button[0].click().run()
+        self._check()
+
+    def audit_view(self, rng):
+        self._goto(AUDIT)
+        self._check()
+
+    def importer_query(self, rng):
+        self._goto(IMPORTER)
+        self.at.text_input[0].input(f"Z_LOADTEST_{self.session_id:04d}")
+        run_button = next(b for b in self.at.button if b.label == "▶️ Esegui Query (F8)")
+        run_button.click().run()
+        self._check()
+
+    def csv_import(self, rng, engine):
+        # AppTest (Streamlit 1.32) non simula st.file_uploader, quindi qui NON si esercita il codice di import di app.py
+        # (write_partitioned / merge_import): è solo carico di scrittura sintetico in background, escluso dalle latenze
+        df = pd.DataFrame({
+            "ID": range(200),
+            "VALORE": [round(rng.uniform(1, 1000), 2) for _ in range(200)],
+        })
+        schema = self.at.session_state["sandbox_schema"]
+        with engine.begin() as conn:
+            if schema is not None:
+                # Stesso ruolo della Sandbox: la tabella resta dello studente e leggibile da importer_query
+                conn.execute(text(f'SET LOCAL ROLE "{schema}"'))
+            df.to_sql(f"Z_LOADTEST_{self.session_id:04d}", conn, schema=schema, if_exists="replace", index=False)
+
+
+def check_sandbox_write(args, engine):
+    """Verifica di isolamento: un UPDATE su una tabella condivisa supera il pre-flight e finisce nella sandbox, non su public"""
+    driver = SessionDriver(0, args.database_url, args.timeout, engine, username="LOADTEST_ISOLATION")
+    with engine.connect() as conn:
+        ebeln = conn.execute(text('SELECT MIN("EBELN") FROM public."EKKO"')).scalar()
+    driver._goto("MM - Procure to Pay")
+    driver.at.text_area(key="sandbox_mm").input(f'UPDATE "EKKO" SET "LIFNR" = \'SANDBOX_CHECK\' WHERE "EBELN" = \'{ebeln}\';')
+    driver.at.button[0].click().run()
+    driver._check()
+    schema = driver.at.session_state["sandbox_schema"]
+    with engine.connect() as conn:
+        private = conn.execute(text(f'SELECT "LIFNR" FROM "{schema}"."EKKO" WHERE "EBELN" = :ebeln'), {"ebeln": ebeln}).scalar()
+        shared = conn.execute(text('SELECT "LIFNR" FROM public."EKKO" WHERE "EBELN" = :ebeln'), {"ebeln": ebeln}).scalar()
+    if private != "SANDBOX_CHECK" or shared == "SANDBOX_CHECK":
+        messages = [element.value for element in list(driver.at.warning) + list(driver.at.error)]
+        raise SystemExit(f"❌ Isolamento sandbox non rispettato (sandbox: {private!r}, public: {shared!r}) {messages}")
+    print(f"✅ UPDATE \"EKKO\" eseguito nella sandbox {schema}, public invariato.")
+
+
+def connections_in_use(engine):
+    if engine.url.get_backend_name() != "postgresql":
+        return None
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT count(*) FROM pg_stat_activity WHERE datname = current_database()")).scalar()
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_session(session_id, args, engine, results, lock):
+    rng = random.Random(args.seed * 100_003 + session_id)
+    driver = SessionDriver(session_id, args.database_url, args.timeout, engine)
+    actions = list(ACTION_WEIGHTS)
+    weights = list(ACTION_WEIGHTS.values())
+    for _ in range(args.actions):
+        action = rng.choices(actions, weights)[0]
+        start = time.perf_counter()
+        ok = True
+        try:
+            if action == "csv_import":
+                driver.csv_import(rng, engine)
+            else:
+                getattr(driver, action)(rng)
+        except Exception:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            results.append({"action": action, "seconds": elapsed, "ok": ok})
+
+
+def sample_connections(engine, stop, samples, interval=0.5):
+    while not stop.is_set():
+        try:
+            count = connections_in_use(engine)
+        except Exception:
+            count = None
+        if count is not None:
+            samples.append(count)
+        stop.wait(interval)
+
+
+def summarize(results, wall_seconds, connection_samples):
+    summary = {"wall_seconds": round(wall_seconds, 3), "actions": {}}
+    measured = [r for r in results if r["action"] not in SYNTHETIC_ACTIONS]
+    summary["throughput_per_s"] = round(len(measured) / wall_seconds, 3) if wall_seconds else 0.0
+    for action in ACTION_WEIGHTS:
+        if action in SYNTHETIC_ACTIONS:
+            continue
+        samples = [r["seconds"] * 1000 for r in results if r["action"] == action]
+        if not samples:
+            continue
+        summary["actions"][action] = {
+            "count": len(samples),
+            "errors": sum(1 for r in results if r["action"] == action and not r["ok"]),
+            "throughput_per_s": round(len(samples) / wall_seconds, 3),
+            "p50_ms": round(statistics.median(samples), 1),
+            "p95_ms": round(percentile(samples, 95), 1),
+            "p99_ms": round(percentile(samples, 99), 1),
+        }
+    summary["synthetic_background"] = {
+        action: {
+            "count": sum(1 for r in results if r["action"] == action),
+            "errors": sum(1 for r in results if r["action"] == action and not r["ok"]),
+        }
+        for action in SYNTHETIC_ACTIONS
+    }
+    if connection_samples:
+        summary["db_connections"] = {"max": max(connection_samples), "avg": round(statistics.mean(connection_samples), 1)}
+    return summary
+
+
+def compare_with_baseline(summary, baseline, tolerance):
+    """Segnala le azioni il cui p95 è peggiorato oltre la tolleranza rispetto alla run di riferimento"""
+    regressions = []
+    for action, stats in summary["actions"].items():
+        previous = baseline.get("actions", {}).get(action)
+        if previous and stats["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{action}: p95 {previous['p95_ms']} ms -> {stats['p95_ms']} ms")
+    return regressions
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Load test multi-sessione per app.py")
+    parser.add_argument("--sessions", type=int, default=10, help="Studenti simultanei")
+    parser.add_argument("--actions", type=int, default=20, help="Azioni per sessione")
+    parser.add_argument("--seed", type=int, default=42, help="Seed del mix di azioni (run confrontabili)")
+    parser.add_argument("--timeout", type=float, default=60, help="Timeout per singola run dello script (s)")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), help="Postgres locale o altro backend SQLAlchemy")
+    parser.add_argument("--output", help="File JSON in cui salvare il report")
+    parser.add_argument("--baseline", help="Report JSON di una run precedente da confrontare")
+    parser.add_argument("--tolerance", type=float, default=0.20, help="Peggioramento p95 ammesso rispetto alla baseline")
+    args = parser.parse_args()
+
+    print(f"🚀 Load test: {args.sessions} sessioni x {args.actions} azioni (seed {args.seed})...")
+    engine = create_engine(args.database_url)
+    if engine.url.get_backend_name() == "postgresql":
+        check_sandbox_write(args, engine)
+    results, connection_samples = [], []
+    lock, stop = threading.Lock(), threading.Event()
+    sampler = threading.Thread(target=sample_connections, args=(engine, stop, connection_samples), daemon=True)
+    sampler.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+        futures = [pool.submit(run_session, session_id, args, engine, results, lock) for session_id in range(args.sessions)]
+        failed_sessions = sum(1 for future in futures if future.exception() is not None)
+    wall_seconds = time.perf_counter() - start
+    stop.set()
+    sampler.join()
+
+    summary = summarize(results, wall_seconds, connection_samples)
+    summary["config"] = {"sessions": args.sessions, "actions": args.actions, "seed": args.seed}
+    summary["failed_sessions"] = failed_sessions
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"✅ Report salvato in {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(summary, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"❌ Regressione: {regression}")
+        if regressions:
+            raise SystemExit(1)
+        print("🎯 Nessuna regressione rispetto alla baseline.")
+
+
+if __name__ == "__main__":
+    main()